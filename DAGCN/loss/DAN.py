@@ -3,7 +3,8 @@ import torch
 
 def guassian_kernel(source, target, kernel_mul=2.0, kernel_num=5, fix_sigma=None):
     n_samples = int(source.size()[0])+int(target.size()[0])
-    total = torch.cat([source, target], dim=0)
+    # Keep the pairwise kernel sums in fp32 to avoid overflow under autocast
+    total = torch.cat([source, target], dim=0).float()
     total0 = total.unsqueeze(0).expand(
         int(total.size(0)), int(total.size(0)), int(total.size(1)))
     total1 = total.unsqueeze(1).expand(
@@ -14,10 +15,11 @@ def guassian_kernel(source, target, kernel_mul=2.0, kernel_num=5, fix_sigma=None
     else:
         bandwidth = torch.sum(L2_distance.data) / (n_samples**2-n_samples)
     bandwidth /= kernel_mul ** (kernel_num // 2)
-    bandwidth_list = [bandwidth * (kernel_mul**i) for i in range(kernel_num)]
-    kernel_val = [torch.exp(-L2_distance / bandwidth_temp)
-                  for bandwidth_temp in bandwidth_list]
-    return sum(kernel_val)  # /len(kernel_val)
+    # Evaluate all the bandwidths at once on a [kernel_num, N, N] tensor
+    bandwidth_list = bandwidth * kernel_mul ** torch.arange(
+        kernel_num, dtype=L2_distance.dtype, device=L2_distance.device)
+    kernel_val = torch.exp(-L2_distance.unsqueeze(0) / bandwidth_list.view(-1, 1, 1))
+    return kernel_val.sum(0)  # /len(kernel_val)
 
 
 def DAN(source, target, kernel_mul=2.0, kernel_num=5, fix_sigma=None):
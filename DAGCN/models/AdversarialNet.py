@@ -26,7 +26,6 @@ class AdversarialNet(nn.Module):
             nn.Dropout(),
         )
         self.ad_layer3 = nn.Linear(hidden_size, 1)
-        self.sigmoid = nn.Sigmoid()
         
         # parameters
         self.iter_num = 0
@@ -47,7 +46,6 @@ class AdversarialNet(nn.Module):
         x = self.ad_layer1(x)
         x = self.ad_layer2(x)
         y = self.ad_layer3(x)
-        y = self.sigmoid(y)
         return y
 
     def output_num(self):
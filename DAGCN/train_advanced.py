@@ -29,22 +29,33 @@ def parse_args():
 
     # training parameters
     parser.add_argument('--cuda_device', type=str,
-                        default='0', help='assign device')
+                        default='0', help='assign device, ignored by the distributed training')
+    parser.add_argument('--local_rank', '--local-rank', type=int,
+                        default=int(os.environ.get('LOCAL_RANK', -1)), help='the local rank for the distributed training')
     parser.add_argument('--checkpoint_dir', type=str,
                         default='./checkpoint', help='the directory to save the model')
     parser.add_argument("--pretrained", type=bool, default=False,
                         help='whether to load the pretrained model')
     parser.add_argument('--batch_size', type=int, default=64,
                         help='batchsize of the training process')
+    parser.add_argument('--eval_batch_size', type=int, default=None,
+                        help='batchsize of the validation process, defaults to batch_size; other values change '
+                             'the val metrics since the graph is built over the whole batch')
     parser.add_argument('--num_workers', type=int, default=0,
                         help='the number of training process')
+    parser.add_argument('--prefetch_factor', type=int, default=2,
+                        help='the number of batches loaded in advance by each worker')
+    parser.add_argument('--amp', type=bool, default=False,
+                        help='whether use the automatic mixed precision training')
+    parser.add_argument('--accumulation_steps', type=int, default=1,
+                        help='the number of mini-batches to accumulate the gradient over')
+    parser.add_argument('--compile', type=bool, default=False,
+                        help='whether compile the model with torch.compile (PyTorch >= 2.0), not used with DataParallel')
 
     parser.add_argument('--bottleneck', type=bool, default=True,
                         help='whether using the bottleneck layer')
     parser.add_argument('--bottleneck_num', type=int,
                         default=256*1, help='the output number of bottleneck layer')
-    parser.add_argument('--drop_last', type=bool,
-                        default=False, help='whether drop the last batch')
 
     # domain adversarial parameters
     parser.add_argument('--domain_adversarial', type=bool,
@@ -90,15 +101,20 @@ def parse_args():
 
 if __name__ == '__main__':
     args = parse_args()
-    os.environ['CUDA_VISIBLE_DEVICES'] = args.cuda_device.strip()
+    # The distributed launcher assigns one visible gpu per local rank itself
+    if args.local_rank == -1:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.cuda_device.strip()
     # Prepare the saving path for the model
     sub_dir = args.model_name + '_' + datetime.strftime(datetime.now(), '%m%d-%H%M%S')
     save_dir = os.path.join(args.checkpoint_dir, sub_dir)
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
 
-    # set the logger
-    setlogger(os.path.join(save_dir, 'train.log'))
+    # Only the main process saves the model and writes the training log
+    if int(os.environ.get('RANK', 0)) == 0:
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        setlogger(os.path.join(save_dir, 'train.log'))
+    else:
+        logging.getLogger().setLevel(logging.WARNING)
 
     # save the args
     for k, v in args.__dict__.items():
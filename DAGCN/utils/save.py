@@ -1,4 +1,18 @@
 import os
+import torch
+
+
+def state_to_cpu(state):
+    """
+    Copy the tensors of a (nested) state dict to the cpu, detached from the training ones
+    """
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: state_to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(value) for value in state)
+    return state
 
 
 class Save_Tool(object):
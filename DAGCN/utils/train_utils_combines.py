@@ -1,15 +1,20 @@
+import contextlib
 import logging
 import os
 import time
 import warnings
 import math
+from concurrent.futures import ThreadPoolExecutor
 import torch
+import torch.distributed as dist
 from torch import nn
 from torch import optim
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
 from utils.lr_scheduler import *
 import models
 import datasets
-from utils.save import Save_Tool
+from utils.save import Save_Tool, state_to_cpu
 from loss.DAN import DAN
 
 
@@ -17,6 +22,8 @@ class train_utils(object):
     def __init__(self, args, save_dir):
         self.args = args
         self.save_dir = save_dir
+        self.save_executor = ThreadPoolExecutor(max_workers=1)
+        self.save_futures = []
 
     def setup(self):
         """
@@ -26,8 +33,17 @@ class train_utils(object):
         """
         args = self.args
 
-        # Consider the gpu or cpu condition
-        if torch.cuda.is_available():
+        # Consider the distributed, gpu or cpu condition
+        self.distributed = args.local_rank != -1
+        self.rank = 0
+        if self.distributed:
+            torch.cuda.set_device(args.local_rank)
+            dist.init_process_group('nccl')
+            self.rank = dist.get_rank()
+            self.device = torch.device("cuda", args.local_rank)
+            self.device_count = 1
+            logging.info('using gpu {} of {} processes'.format(args.local_rank, dist.get_world_size()))
+        elif torch.cuda.is_available():
             self.device = torch.device("cuda")
             self.device_count = torch.cuda.device_count()
             logging.info('using {} gpus'.format(self.device_count))
@@ -37,6 +53,11 @@ class train_utils(object):
             self.device = torch.device("cpu")
             self.device_count = 1
             logging.info('using {} cpu'.format(self.device_count))
+        assert args.accumulation_steps >= 1, "accumulation steps should be at least 1"
+
+        # The signal length is fixed, so let cuDNN benchmark and cache the fastest convolution algorithms
+        if self.device.type == 'cuda':
+            torch.backends.cudnn.benchmark = True
 
         # Load the datasets
         Dataset = getattr(datasets, args.data_name)
@@ -45,12 +66,27 @@ class train_utils(object):
             args.transfer_task = eval("".join(args.transfer_task))
         self.datasets['source_train'], self.datasets['source_val'], self.datasets['target_train'], self.datasets['target_val'] = Dataset(
             args.data_dir, args.transfer_task, args.normalizetype).data_split(transfer_learning=True)
-        self.dataloaders = {x: torch.utils.data.DataLoader(self.datasets[x], batch_size=args.batch_size,
-                                                           shuffle=(True if x.split('_')[1] == 'train' else False),
-                                                           num_workers=args.num_workers,
-                                                           pin_memory=(True if self.device == 'cuda' else False),
-                                                           drop_last=(True if args.drop_last and x.split('_')[1] == 'train' else False))
-                            for x in ['source_train', 'source_val', 'target_train', 'target_val']}
+        # Keep the workers alive across epochs, both options require num_workers > 0
+        worker_kwargs = dict(persistent_workers=True, prefetch_factor=args.prefetch_factor) \
+            if args.num_workers > 0 else {}
+        self.samplers = {}
+        self.dataloaders = {}
+        for x in ['source_train', 'source_val', 'target_train', 'target_val']:
+            # Full train batches keep the domain labels aligned. MRF_GCN builds its graph over the
+            # whole batch, so the val splits use the train batch size unless eval_batch_size is set
+            is_train = x.endswith('_train')
+            batch_size = args.eval_batch_size if not is_train and args.eval_batch_size else args.batch_size
+            # Only the train splits are sharded, DistributedSampler pads a split with duplicated
+            # samples, so every rank evaluates the complete val splits
+            if self.distributed and is_train:
+                self.samplers[x] = DistributedSampler(self.datasets[x], shuffle=True)
+            self.dataloaders[x] = torch.utils.data.DataLoader(self.datasets[x], batch_size=batch_size,
+                                                              shuffle=(is_train and not self.distributed),
+                                                              sampler=self.samplers.get(x),
+                                                              num_workers=args.num_workers,
+                                                              pin_memory=(self.device.type == 'cuda'),
+                                                              drop_last=is_train,
+                                                              **worker_kwargs)
 
         # Define the model
         self.model = getattr(models, args.model_name)(args.pretrained)
@@ -72,41 +108,63 @@ class train_utils(object):
                 self.AdversarialNet = getattr(models, 'AdversarialNet')(in_feature=self.model.output_num(),
                                                                     hidden_size=args.hidden_size, max_iter=self.max_iter)
 
-        if self.device_count > 1:
-            self.model = torch.nn.DataParallel(self.model)
-            if args.bottleneck:
-                self.bottleneck_layer = torch.nn.DataParallel(self.bottleneck_layer)
+        # Invert the model before wrapping it for the parallel training
+        self.model.to(self.device)
+        if args.bottleneck:
+            self.bottleneck_layer.to(self.device)
+        if args.domain_adversarial:
+            self.AdversarialNet.to(self.device)
+        self.classifier_layer.to(self.device)
+
+        # The transfer losses use the bottleneck features and the logits separately, so the
+        # feature extractor is wrapped as a whole instead of the sequential model_all
+        if args.bottleneck:
+            self.feature_extractor = nn.Sequential(self.model, self.bottleneck_layer)
+        else:
+            self.feature_extractor = self.model
+
+        if self.distributed:
+            ddp_kwargs = dict(device_ids=[args.local_rank], output_device=args.local_rank,
+                              bucket_cap_mb=25, gradient_as_bucket_view=True)
+            self.feature_extractor = DistributedDataParallel(self.feature_extractor, **ddp_kwargs)
+            if args.domain_adversarial:
+                self.AdversarialNet = DistributedDataParallel(self.AdversarialNet, **ddp_kwargs)
+            self.classifier_layer = DistributedDataParallel(self.classifier_layer, **ddp_kwargs)
+            self.ddp_modules = [self.feature_extractor, self.classifier_layer]
+            if args.domain_adversarial:
+                self.ddp_modules.append(self.AdversarialNet)
+        elif self.device_count > 1:
+            # The classifier is a single linear layer on the gathered features, scattering it does not pay off
+            self.feature_extractor = torch.nn.DataParallel(self.feature_extractor)
             if args.domain_adversarial:
                 self.AdversarialNet = torch.nn.DataParallel(self.AdversarialNet)
-            self.classifier_layer = torch.nn.DataParallel(self.classifier_layer)
 
-        # Define the learning parameters
-        if args.domain_adversarial:
-            if args.bottleneck:
-                parameter_list = [{"params": self.model.parameters(), "lr": args.lr},
-                                  {"params": self.bottleneck_layer.parameters(),"lr": args.lr},
-                                  {"params": self.classifier_layer.parameters(),"lr": args.lr},
-                                  {"params": self.AdversarialNet.parameters(), "lr": args.lr}]
+        # Compile the modules once, the first iterations pay the compilation cost. The DDP wrappers are
+        # compiled as PyTorch recommends, DataParallel cannot replicate a compiled module. AdversarialNet
+        # stays eager, its per-step iter_num counter would fail the guards and recompile every step
+        if args.compile:
+            if self.device_count > 1:
+                warnings.warn("torch.compile does not support DataParallel, the model is not compiled")
             else:
-                parameter_list = [{"params": self.model.parameters(), "lr": args.lr},
-                                  {"params": self.classifier_layer.parameters(),"lr": args.lr},
-                                  {"params": self.AdversarialNet.parameters(), "lr": args.lr}]
-        else:
-            if args.bottleneck:
-                parameter_list = [{"params": self.model.parameters(), "lr": args.lr},
-                                  {"params": self.bottleneck_layer.parameters(),"lr": args.lr},
-                                  {"params": self.classifier_layer.parameters(), "lr": args.lr}]
-            else:
-                parameter_list = [{"params": self.model.parameters(), "lr": args.lr},
-                                  {"params": self.classifier_layer.parameters(), "lr": args.lr}]
+                self.feature_extractor = torch.compile(self.feature_extractor, mode='reduce-overhead')
+                self.classifier_layer = torch.compile(self.classifier_layer)
+
+        # Define the learning parameters, all the modules share args.lr so a single group
+        # keeps the multi-tensor (foreach/fused) update path of the optimizer
+        parameter_list = list(self.model.parameters())
+        if args.bottleneck:
+            parameter_list += list(self.bottleneck_layer.parameters())
+        parameter_list += list(self.classifier_layer.parameters())
+        if args.domain_adversarial:
+            parameter_list += list(self.AdversarialNet.parameters())
 
         # Define the optimizer
         if args.opt == 'sgd':
             self.optimizer = optim.SGD(parameter_list, lr=args.lr,
-                                       momentum=args.momentum, weight_decay=args.weight_decay)
+                                       momentum=args.momentum, weight_decay=args.weight_decay, foreach=True)
         elif args.opt == 'adam':
             self.optimizer = optim.Adam(parameter_list, lr=args.lr,
-                                        weight_decay=args.weight_decay)
+                                        weight_decay=args.weight_decay, fused=(self.device.type == 'cuda'))
         else:
             raise Exception("optimizer not implement")
 
@@ -134,26 +192,44 @@ class train_utils(object):
         if args.resume:
             suffix = args.resume.rsplit('.', 1)[-1]
             if suffix == 'tar':
-                checkpoint = torch.load(args.resume)
+                checkpoint = torch.load(args.resume, map_location=self.device)
                 self.model_all.load_state_dict(checkpoint['model_state_dict'])
                 self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
                 self.start_epoch = checkpoint['epoch'] + 1
             elif suffix == 'pth':
-                self.model_all.load_state_dict(torch.load(args.resume, map_location=args.device))
+                self.model_all.load_state_dict(torch.load(args.resume, map_location=self.device))
 
-        # Invert the model and define the loss
-        self.model.to(self.device)
-        if args.bottleneck:
-            self.bottleneck_layer.to(self.device)
-        if args.domain_adversarial:
-            self.AdversarialNet.to(self.device)
-        self.classifier_layer.to(self.device)
+        # Define the gradient scaler for the mixed precision training
+        self.scaler = torch.cuda.amp.GradScaler(enabled=args.amp)
 
-        # Define the adversarial loss
-        self.adversarial_loss = nn.BCELoss()
+        # Define the adversarial loss and preallocate the domain labels,
+        # batch_size ones for the source followed by batch_size zeros for the target
+        self.adversarial_loss = nn.BCEWithLogitsLoss()
+        self.adv_label = torch.cat((torch.ones(args.batch_size), torch.zeros(args.batch_size)), dim=0).to(self.device)
         self.structure_loss = DAN
         self.criterion = nn.CrossEntropyLoss()
 
+    def no_sync(self, accumulate):
+        """
+        Skip the gradient all-reduce of the DDP modules on accumulation mini-batches
+        :param accumulate: whether the optimizer does not step after this mini-batch
+        :return:
+        """
+        stack = contextlib.ExitStack()
+        if self.distributed and accumulate:
+            for module in self.ddp_modules:
+                stack.enter_context(module.no_sync())
+        return stack
+
+    def wait_for_saving(self):
+        """
+        Wait for the pending checkpoints and raise the error of a failed one
+        :return:
+        """
+        for future in self.save_futures:
+            future.result()
+        self.save_futures = []
+
     def train(self):
         """
         Training process
@@ -164,9 +240,10 @@ class train_utils(object):
         step = 0
         best_acc = 0.0
 
+        # The running sums stay on the device and are only read back when they are logged
         batch_count = 0
-        batch_loss = 0.0
-        batch_acc = 0
+        batch_loss = torch.zeros((), device=self.device)
+        batch_acc = torch.zeros((), dtype=torch.long, device=self.device)
 
         step_start = time.time()
 
@@ -183,16 +260,20 @@ class train_utils(object):
             else:
                 logging.info('current lr: {}'.format(args.lr))
 
-            iter_target = iter(self.dataloaders['target_train'])
-            len_target_loader = len(self.dataloaders['target_train'])
+            for sampler in self.samplers.values():
+                sampler.set_epoch(epoch)
 
             # Each epoch has a training and val phase
             for phase in ['source_train', 'source_val', 'target_val']:
 
+                # The target samples are only consumed by the transfer phase
+                if phase == 'source_train' and epoch >= args.middle_epoch:
+                    iter_target = iter(self.dataloaders['target_train'])
+
                 # Define the temp variable
                 epoch_start = time.time()
-                epoch_acc = 0
-                epoch_loss = 0.0
+                epoch_acc = torch.zeros((), dtype=torch.long, device=self.device)
+                epoch_loss = torch.zeros((), device=self.device)
                 epoch_length = 0
 
                 # Set model to train mode or test mode
@@ -212,59 +293,73 @@ class train_utils(object):
                     self.classifier_layer.eval()
 
                 for batch_idx, (inputs, labels) in enumerate(self.dataloaders[phase]):
-                    
+
+                    # The optimizer steps every accumulation_steps mini-batches and at the end of the phase,
+                    # where the last window may hold fewer mini-batches
+                    window_start = batch_idx - batch_idx % args.accumulation_steps
+                    window_size = min(args.accumulation_steps, len(self.dataloaders[phase]) - window_start)
+                    sync_step = batch_idx + 1 == window_start + window_size
+
                     if phase != 'source_train' or epoch < args.middle_epoch:
-                        inputs = inputs.to(self.device)
-                        labels = labels.to(self.device)
+                        inputs = inputs.to(self.device, non_blocking=True)
+                        labels = labels.to(self.device, non_blocking=True)
                     else:
-                        source_inputs = inputs
-                        target_inputs, target_labels = next(iter_target)
+                        # Restart the target loader only once it is exhausted
+                        try:
+                            target_inputs, target_labels = next(iter_target)
+                        except StopIteration:
+                            iter_target = iter(self.dataloaders['target_train'])
+                            target_inputs, target_labels = next(iter_target)
+                        # Copy the pinned halves and concatenate them on the device
+                        source_inputs = inputs.to(self.device, non_blocking=True)
+                        target_inputs = target_inputs.to(self.device, non_blocking=True)
                         inputs = torch.cat((source_inputs, target_inputs), dim=0)
-                        inputs = inputs.to(self.device)
-                        labels = labels.to(self.device)
-                    if (step + 1) % len_target_loader == 0:
-                        iter_target = iter(self.dataloaders['target_train'])
+                        labels = labels.to(self.device, non_blocking=True)
+
+                    # The validation phases run without any autograd bookkeeping
+                    grad_mode = torch.enable_grad() if phase == 'source_train' else torch.inference_mode()
+                    with self.no_sync(phase == 'source_train' and not sync_step), grad_mode:
 
-                    with torch.set_grad_enabled(phase == 'source_train'):
-                        
                         # Forward
-                        features = self.model(inputs)
-                        if args.bottleneck:
-                            features = self.bottleneck_layer(features)
-                        outputs = self.classifier_layer(features)
-
-                        if phase != 'source_train' or epoch < args.middle_epoch:
-                            logits = outputs
-                            loss = self.criterion(logits, labels)
-                        else:
-                            logits = outputs.narrow(0, 0, labels.size(0))
-                            classifier_loss = self.criterion(logits, labels)
-
-                        if phase == 'source_train' and epoch >= args.middle_epoch:
-
-                            # Calculate the domain adversarial loss
-                            domain_label_source = torch.ones(labels.size(0)).float()
-                            domain_label_target = torch.zeros(inputs.size(0)-labels.size(0)).float()
-                            adversarial_label = torch.cat((domain_label_source, domain_label_target), dim=0).to(self.device)
-                            adversarial_out = self.AdversarialNet(features)
-                            adversarial_loss = self.adversarial_loss(adversarial_out.squeeze(), adversarial_label)
-
-                            # Calculate the structure loss
-                            structure_loss = self.structure_loss(features.narrow(0, 0, labels.size(0)),
-                                                                 features.narrow(0, labels.size(0), inputs.size(0) - labels.size(0)))
-
-                            if args.trade_off_adversarial == 'Cons':
-                                lam_adversarial = args.lam_adversarial
-                            elif args.trade_off_adversarial == 'Step':
-                                lam_adversarial = 2 / (1 + math.exp(-10 * ((epoch-args.middle_epoch) / (args.max_epoch-args.middle_epoch)))) - 1
-                            else:
-                                raise Exception("loss not implement")
+                        with torch.cuda.amp.autocast(enabled=args.amp):
+                            features = self.feature_extractor(inputs)
 
-                            loss = classifier_loss + lam_adversarial * adversarial_loss + lam_adversarial * structure_loss
+                            if phase != 'source_train' or epoch < args.middle_epoch:
+                                logits = self.classifier_layer(features)
+                                loss = self.criterion(logits, labels)
+                            else:
+                                # The source samples lead the batch and the target samples follow
+                                source_size = labels.size(0)
+                                target_size = inputs.size(0) - source_size
+                                source_features = features.narrow(0, 0, source_size)
+                                target_features = features.narrow(0, source_size, target_size)
+                                # Only the source samples are labelled, skip classifying the target ones
+                                logits = self.classifier_layer(source_features)
+                                classifier_loss = self.criterion(logits, labels)
+
+                            if phase == 'source_train' and epoch >= args.middle_epoch:
+
+                                # Calculate the domain adversarial loss
+                                # The train loaders drop the last batch, so both halves hold batch_size samples
+                                adversarial_label = self.adv_label
+                                adversarial_out = self.AdversarialNet(features)
+                                adversarial_loss = self.adversarial_loss(adversarial_out.squeeze(), adversarial_label)
+
+                                # Calculate the structure loss
+                                structure_loss = self.structure_loss(source_features, target_features)
+
+                                if args.trade_off_adversarial == 'Cons':
+                                    lam_adversarial = args.lam_adversarial
+                                elif args.trade_off_adversarial == 'Step':
+                                    lam_adversarial = 2 / (1 + math.exp(-10 * ((epoch-args.middle_epoch) / (args.max_epoch-args.middle_epoch)))) - 1
+                                else:
+                                    raise Exception("loss not implement")
+
+                                loss = classifier_loss + lam_adversarial * adversarial_loss + lam_adversarial * structure_loss
 
                         pred = logits.argmax(dim=1)
-                        correct = torch.eq(pred, labels).float().sum().item()
-                        loss_temp = loss.item() * labels.size(0)
+                        correct = (pred == labels).sum()
+                        loss_temp = loss.detach() * labels.size(0)
                         epoch_loss += loss_temp
                         epoch_acc += correct
                         epoch_length += labels.size(0)
@@ -272,54 +367,68 @@ class train_utils(object):
                         # Calculate the training information
                         if phase == 'source_train':
                             # Backward
-                            self.optimizer.zero_grad()
-                            loss.backward()
-                            self.optimizer.step()
+                            self.scaler.scale(loss / window_size).backward()
 
                             batch_loss += loss_temp
                             batch_acc += correct
                             batch_count += labels.size(0)
-                            # Print the training information
-                            if step % args.print_step == 0:
-                                batch_loss = batch_loss / batch_count
-                                batch_acc = batch_acc / batch_count
-                                temp_time = time.time()
-                                train_time = temp_time - step_start
-                                step_start = temp_time
-                                batch_time = train_time / args.print_step if step != 0 else train_time
-                                sample_per_sec = 1.0 * batch_count / train_time
-                                logging.info('Epoch: {} [{}/{}], Train Loss: {:.4f} Train Acc: {:.4f},'
-                                             '{:.1f} samples/sec {:.2f} sec/batch'.format(
-                                                 epoch, batch_idx * len(labels), 
-                                                 len(self.dataloaders[phase].dataset),
-                                                 batch_loss, batch_acc, sample_per_sec, batch_time
-                                             ))
-                                batch_acc = 0
-                                batch_loss = 0.0
-                                batch_count = 0
-                            step += 1
+
+                            if sync_step:
+                                self.scaler.step(self.optimizer)
+                                self.scaler.update()
+                                self.optimizer.zero_grad(set_to_none=True)
+
+                                # Print the training information
+                                if step % args.print_step == 0:
+                                    train_loss = batch_loss.item() / batch_count
+                                    train_acc = batch_acc.item() / batch_count
+                                    temp_time = time.time()
+                                    train_time = temp_time - step_start
+                                    step_start = temp_time
+                                    batch_time = train_time / args.print_step if step != 0 else train_time
+                                    sample_per_sec = 1.0 * batch_count / train_time
+                                    logging.info('Epoch: {} [{}/{}], Train Loss: {:.4f} Train Acc: {:.4f},'
+                                                 '{:.1f} samples/sec {:.2f} sec/batch'.format(
+                                                     epoch, batch_idx * len(labels), 
+                                                     len(self.dataloaders[phase].dataset),
+                                                     train_loss, train_acc, sample_per_sec, batch_time
+                                                 ))
+                                    batch_acc.zero_()
+                                    batch_loss.zero_()
+                                    batch_count = 0
+                                step += 1
 
                 # Print the train and val information via each epoch
+                epoch_stats = torch.stack((epoch_loss, epoch_acc.float(), epoch_loss.new_tensor(epoch_length)))
+                if self.distributed and phase == 'source_train':
+                    dist.all_reduce(epoch_stats)
+                epoch_loss, epoch_acc, epoch_length = epoch_stats.tolist()
                 epoch_loss = epoch_loss / epoch_length
                 epoch_acc = epoch_acc / epoch_length
                 logging.info('Epoch: {} {}-Loss: {:.4f} {}-Acc: {:.4f}, Cost {:.1f} sec'.format(
                     epoch, phase, epoch_loss, phase, epoch_acc, time.time() - epoch_start))
 
                 # Save the model
-                if phase == 'target_val':
+                if phase == 'target_val' and self.rank == 0:
+                    # Snapshot the states once and serialize them in the background
+                    self.wait_for_saving()
+                    model_state_dic = state_to_cpu(self.model_all.state_dict())
+
                     # Save the checkpoint for other learning
-                    model_state_dic = self.model_all.state_dict()
                     save_path = os.path.join(self.save_dir, '{}_ckpt.tar'.format(epoch))
-                    torch.save({
+                    self.save_futures.append(self.save_executor.submit(torch.save, {
                         'epoch': epoch,
-                        'optimizer_state_dict': self.optimizer.state_dict(),
+                        'optimizer_state_dict': state_to_cpu(self.optimizer.state_dict()),
                         'model_state_dict': model_state_dic
-                    }, save_path)
-                    save_list.update(save_path)
+                    }, save_path))
+                    self.save_futures.append(self.save_executor.submit(save_list.update, save_path))
 
                     # Save the best model according to the val accuracy
                     if (epoch_acc > best_acc or epoch > args.max_epoch-2) and (epoch > args.middle_epoch-1):
                         best_acc = epoch_acc
                         logging.info("save best model epoch {}, acc {:.4f}".format(epoch, epoch_acc))
-                        torch.save(model_state_dic,
-                                   os.path.join(self.save_dir, '{}-{:.4f}-best_model.pth'.format(epoch, best_acc)))
+                        self.save_futures.append(self.save_executor.submit(
+                            torch.save, model_state_dic,
+                            os.path.join(self.save_dir, '{}-{:.4f}-best_model.pth'.format(epoch, best_acc))))
+
+        self.wait_for_saving()